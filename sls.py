@@ -1,19 +1,132 @@
+import calendar
+import io
+import json
 import os
-import pickle
+import shutil
 import sys
+import tempfile
 from argparse import ArgumentParser
 from configparser import ConfigParser
 from datetime import datetime
 from getpass import getpass
 from hashlib import md5
-from math import ceil
 
 from pylast import LibreFMNetwork, SessionKeyGenerator, WSError
-from spotipy import Spotify, SpotifyOAuth
+from requests import Session
+from requests.adapters import HTTPAdapter
+from spotipy import SpotifyOAuth
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+RECENTLY_PLAYED_URL = "https://api.spotify.com/v1/me/player/recently-played"
+LEGACY_TRACKS_FILE = ".tracks.pickle"
 
 
 def hash_librefm_password(password):
-    return md5(password.encode("utf8")).hexdigest()
+    try:
+        password_hash = md5(password.encode("utf8"), usedforsecurity=False)
+    except TypeError:  # usedforsecurity was added in Python 3.9
+        password_hash = md5(password.encode("utf8"))
+    return password_hash.hexdigest()
+
+
+def parse_played_at(played_at):
+    # Spotify always returns UTC timestamps like 2020-10-14T12:34:56.789Z
+    return calendar.timegm(
+        (
+            int(played_at[0:4]),
+            int(played_at[5:7]),
+            int(played_at[8:10]),
+            int(played_at[11:13]),
+            int(played_at[14:16]),
+            int(played_at[17:19]),
+            0,
+            0,
+            0,
+        )
+    )
+
+
+class TrackInfo:
+    # Lightweight mapping-like record accepted by pylast's scrobble_many
+    __slots__ = ("artist", "title", "album", "track_number", "duration", "timestamp")
+
+    def __init__(self, artist, title, album, track_number, duration, timestamp):
+        self.artist = artist
+        self.title = title
+        self.album = album
+        self.track_number = track_number
+        self.duration = duration
+        self.timestamp = timestamp
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+
+def get_track_info(track):
+    spotify_track = track["track"]
+    return TrackInfo(
+        spotify_track["artists"][0]["name"],
+        spotify_track["name"],
+        spotify_track["album"]["name"],
+        spotify_track.get("track_number"),
+        (spotify_track["duration_ms"] + 999) // 1000,
+        parse_played_at(track["played_at"]),
+    )
+
+
+def build_session():
+    session = Session()
+    retry = Retry(
+        total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)
+    )
+    session.mount(
+        "https://", HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry)
+    )
+    return session
+
+
+def serialize_config(config):
+    buffer = io.StringIO()
+    config.write(buffer)
+    return buffer.getvalue()
+
+
+def write_config(filename, contents):
+    # Write to a synced temporary file and rename it so a crash never leaves a torn
+    # config. mkstemp creates it as 0600; an existing config keeps its own mode.
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as config_file:
+            config_file.write(contents)
+            config_file.flush()
+            os.fsync(config_file.fileno())
+        if os.path.isfile(filename):
+            shutil.copymode(filename, tmp_filename)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def get_recently_played(session, token, after=None, limit=50):
+    response = session.get(
+        RECENTLY_PLAYED_URL,
+        params={"after": after, "limit": limit},
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=5,
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content) if orjson else response.json()
 
 
 def init_config(**kwargs):
@@ -53,13 +166,25 @@ def init_config(**kwargs):
 
     print("-" * 27)
     print(f"Saving config to {config_filename}")
-    with open(config_filename, "w") as config_file:
-        config.write(config_file)
+    write_config(config_filename, serialize_config(config))
 
 
 def save_tracks(filename, tracks):
-    with open(filename, "wb") as pickle_file:
-        pickle.dump(tracks, pickle_file, pickle.HIGHEST_PROTOCOL)
+    with open(filename, "w") as tracks_file:
+        json.dump(tracks, tracks_file, separators=(",", ":"))
+
+
+def load_tracks(filename):
+    try:
+        with open(filename) as tracks_file:
+            return json.load(tracks_file)
+    except ValueError as err:
+        print(f"Error reading saved tracks from {filename}: not a JSON tracks file")
+        print(err)
+        print(
+            "Tracks files saved by older versions are pickles: scrobble them by running the old version once, or delete the file"
+        )
+        sys.exit(1)
 
 
 def main(**kwargs):
@@ -76,23 +201,33 @@ def main(**kwargs):
     else:
         config["spotify"] = dict()
         config["libre.fm"] = dict()
+    original_config = serialize_config(config)
 
+    session = build_session()
     try:
+        spotify_conf = {key.lower(): value for key, value in config["spotify"].items()}
         auth = SpotifyOAuth(
-            kwargs["spotify_client_id"] or config["spotify"]["CLIENT_ID"],
-            kwargs["spotify_client_secret"] or config["spotify"]["CLIENT_SECRET"],
-            kwargs["spotify_redirect_uri"] or config["spotify"]["REDIRECT_URI"],
-            username=kwargs["spotify_user"] or config["spotify"]["USERNAME"],
-            cache_path=kwargs["cache_path"] or config["spotify"]["CACHE_PATH"],
+            kwargs["spotify_client_id"] or spotify_conf["client_id"],
+            kwargs["spotify_client_secret"] or spotify_conf["client_secret"],
+            kwargs["spotify_redirect_uri"] or spotify_conf["redirect_uri"],
+            username=kwargs["spotify_user"] or spotify_conf["username"],
+            cache_path=kwargs["cache_path"] or spotify_conf["cache_path"],
             scope="user-read-recently-played",
+            requests_session=session,
         )
     except KeyError as err:
         print(f"Missing Spotify config/parameter {err}")
         sys.exit(1)
 
+    token_info = None
     if kwargs["force_refresh_token"]:
-        auth.refresh_access_token(auth.get_cached_token()["refresh_token"])
-    spotify = Spotify(auth_manager=auth)
+        cached_token = auth.get_cached_token()
+        if cached_token:
+            token_info = auth.refresh_access_token(cached_token["refresh_token"])
+    if token_info:
+        token = token_info["access_token"]
+    else:
+        token = auth.get_access_token(as_dict=False)
 
     print("Searching recent tracks")
     if kwargs["search_after"]:
@@ -103,37 +238,27 @@ def main(**kwargs):
             * 1000
         )
     else:
-        last_timestamp = kwargs["last_timestamp"] or config["spotify"].get(
-            "LAST_TIMESTAMP"
-        )
-    recent_tracks = spotify.current_user_recently_played(after=last_timestamp)
+        last_timestamp = kwargs["last_timestamp"] or spotify_conf.get("last_timestamp")
+    recent_tracks = get_recently_played(session, token, after=last_timestamp)
     cursors = recent_tracks["cursors"]
     last_timestamp = cursors["after"] if cursors is not None else last_timestamp
     config["spotify"]["LAST_TIMESTAMP"] = last_timestamp
     tracks_file = kwargs["tracks_file"]
     spotify_tracks = recent_tracks["items"]
+    if kwargs["scrobble_remaining"] and os.path.isfile(LEGACY_TRACKS_FILE):
+        print(f"Warning: found {LEGACY_TRACKS_FILE} saved by an older version")
+        print(
+            "Its tracks are not scrobbled anymore: run the old version once to scrobble them, or delete the file"
+        )
     if kwargs["scrobble_remaining"] and os.path.isfile(tracks_file):
-        with open(tracks_file, "rb") as pickle_file:
-            spotify_tracks.extend(pickle.load(pickle_file))
+        spotify_tracks.extend(load_tracks(tracks_file))
     print(f"Found {len(spotify_tracks)} tracks to scrobble!")
 
     print("Organizing tracks...")
     tracks = []
     for track in spotify_tracks:
         try:
-            track_info = {
-                "artist": track["track"]["artists"][0]["name"],
-                "title": track["track"]["name"],
-                "album": track["track"]["album"]["name"],
-                "track_number": track["track"].get("track_number"),
-                "duration": ceil(track["track"]["duration_ms"] / 1000),
-                "timestamp": int(
-                    datetime.strptime(
-                        track["played_at"], "%Y-%m-%dT%H:%M:%S.%f%z"
-                    ).timestamp()
-                ),
-            }
-            tracks.append(track_info)
+            tracks.append(get_track_info(track))
         except Exception as err:
             print("Error reading track metadata")
             print(err)
@@ -142,18 +267,18 @@ def main(**kwargs):
             save_tracks(tracks_file, spotify_tracks)
             sys.exit(1)
 
-    librefm_auth = {key.lower(): value for key, value in config["libre.fm"].items()}
-    librefm_auth["username"] = kwargs["librefm_user"] or librefm_auth["username"]
-    librefm_auth["password_hash"] = (
-        hash_librefm_password(kwargs["librefm_password"])
-        if kwargs["librefm_password"]
-        else librefm_auth["password_hash"]
-    )
     if tracks:
+        librefm_auth = {key.lower(): value for key, value in config["libre.fm"].items()}
+        librefm_auth["username"] = kwargs["librefm_user"] or librefm_auth["username"]
+        librefm_auth["password_hash"] = (
+            hash_librefm_password(kwargs["librefm_password"])
+            if kwargs["librefm_password"]
+            else librefm_auth["password_hash"]
+        )
         tries = 10
+        librefm = LibreFMNetwork(**librefm_auth)
         while tries:
             tries -= 1
-            librefm = LibreFMNetwork(**librefm_auth)
             print("Scrobbling tracks...")
             try:
                 librefm.scrobble_many(tracks)
@@ -166,9 +291,10 @@ def main(**kwargs):
                 input("Press ENTER when done")
                 session_key = skg.get_web_auth_session_key(url)
                 librefm_auth["session_key"] = session_key
+                librefm = LibreFMNetwork(**librefm_auth)
             else:
                 print("Scrobbling successful!")
-                config["libre.fm"]["SESSION_KEY"] = librefm_auth["session_key"]
+                config["libre.fm"]["SESSION_KEY"] = librefm.session_key
                 break
         else:
             print("Scrobbling unsuccessful :(")
@@ -177,9 +303,12 @@ def main(**kwargs):
             sys.exit(1)
 
     if kwargs["write_config"]:
-        with open(config_file, "w") as config_file:
-            config.write(config_file)
-        print("Saved config file! ;)")
+        new_config = serialize_config(config)
+        if new_config != original_config:
+            write_config(config_file, new_config)
+            print("Saved config file! ;)")
+        else:
+            print("Config unchanged, nothing to save")
 
 
 if __name__ == "__main__":
@@ -204,8 +333,8 @@ if __name__ == "__main__":
     )
     scrobble_parser.add_argument(
         "--tracks-file",
-        default=".tracks.pickle",
-        help="File to save non-scrobbled tracks in case of any error",
+        default=".tracks.json",
+        help="JSON file to save non-scrobbled tracks in case of any error (default: %(default)s)",
     )
     scrobble_parser.add_argument(
         "--ignore-tracks-file",